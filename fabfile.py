@@ -35,26 +35,21 @@ class DecryptedFiles(object):
         fh = tempfile.NamedTemporaryFile()
         cls.tempfiles.append(fh)
 
-        result = gpg('-d', path)
-
-        fh.write(result.stdout)
+        # gpg writes the plaintext straight into the temporary file
+        gpg('-d', path, _out=fh)
         fh.flush()
 
         return fh.name
 
 SHIFTIT_GITHUB_USER = os.environ['SHIFTIT_GITHUB_USER']
 SHIFTIT_GITHUB_REPO = os.environ['SHIFTIT_GITHUB_REPO']
+# Optional number of the release milestone; when set it is fetched directly instead of scanning the milestones by title
+SHIFTIT_GITHUB_MILESTONE = os.environ.get('SHIFTIT_GITHUB_MILESTONE')
 
-proj_name = 'ShiftIt'
-proj_info_plist = 'ShiftIt-Info.plist'
-proj_src_dir = 'ShiftIt'
-
-# GitHub token for release automation
-proj_github_token_file = DecryptedFiles.get_decrypted_key_path(os.environ.get('SHIFTIT_GITHUB_TOKEN', os.path.expanduser('~/Keys/ShiftIt/github.token')))
-
-# Sparkle sign_update tool path - reads EdDSA key from macOS Keychain by default
-# The private key is stored in Keychain under service "https://sparkle-project.org" with account "ed25519"
-proj_sign_update_tool = os.environ.get('SHIFTIT_SIGN_UPDATE', os.path.join(os.path.dirname(__file__), 'ShiftIt', 'bin', 'sign_update'))
+# A gpg-encrypted GitHub token is cached in macOS Keychain under this service and account after the first decryption
+# Delete the item (security delete-generic-password -s shiftit -a shiftit-github-token) to pick up a new token
+GITHUB_TOKEN_KEYCHAIN_SERVICE = 'shiftit'
+GITHUB_TOKEN_KEYCHAIN_ACCOUNT = 'shiftit-github-token'
 
 release_notes_template_html = '''
 <!DOCTYPE HTML PUBLIC "-//IETF//DTD HTML//EN">
@@ -116,12 +111,15 @@ appcast_template = '''
 </rss>
 '''.strip()
 
-from invoke import task, run
+import subprocess
+
+from invoke import task
 from invoke.context import Context
 
 # Compatibility layer for Fabric 1.x to 3.x migration
-def local(cmd, capture=False):
-    result = run(cmd, hide=capture, warn=True)
+def local(cmd, capture=False, cwd=None):
+    # argument lists are executed directly, strings go through the shell
+    result = subprocess.run(cmd, shell=isinstance(cmd, str), cwd=cwd, capture_output=capture, text=True)
     if capture:
         return result.stdout
     return result
@@ -134,15 +132,12 @@ def green(msg):
 
 class lcd:
     def __init__(self, path):
-        import os
         self.path = path
         self.old_path = None
     def __enter__(self):
-        import os
         self.old_path = os.getcwd()
         os.chdir(self.path)
     def __exit__(self, *args):
-        import os
         os.chdir(self.old_path)
 
 class settings:
@@ -157,13 +152,28 @@ def execute(func):
     ctx = Context()
     return func(ctx)
 
-from xml.etree import ElementTree
+import plistlib
+import re
 
-import pystache
+import chevron
+from chevron.tokenizer import tokenize
 import github3
-import tempfile
+import nacl.signing
 import base64
 import datetime
+import functools
+from types import SimpleNamespace
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
+
+################################################################################
+## Templates
+################################################################################
+
+# tokenized once so that each render only walks the token list
+_parsed_release_notes_html = list(tokenize(release_notes_template_html))
+_parsed_release_notes_md = list(tokenize(release_notes_template_md))
+_parsed_appcast = list(tokenize(appcast_template))
 
 ################################################################################
 ## Code
@@ -176,70 +186,214 @@ def _find(f, seq):
     if f(item):
       return item
 
+@functools.lru_cache(maxsize=None)
+def _read_plist(path):
+    with open(path, 'rb') as f:
+        return plistlib.load(f)
+
 def _get_bundle_version(info_plist):
-    version = local('defaults read %s CFBundleVersion' % info_plist, capture=True)
-    return version.strip()
+    return _read_plist(info_plist)['CFBundleVersion'].strip()
 
+@functools.lru_cache(maxsize=1)
 def _get_milestone():
-    milestone = _find(lambda m: proj_version.startswith(m.title), shiftit.iter_milestones())
+    if SHIFTIT_GITHUB_MILESTONE:
+        milestone = _shiftit().milestone(int(SHIFTIT_GITHUB_MILESTONE))
+    else:
+        milestone = _find(lambda m: proj().version.startswith(m.title), _shiftit().milestones(number=-1))
+
     if not milestone:
-        raise Exception('Unable to find milestone: %s' % proj_version)
+        raise Exception('Unable to find milestone: %s' % (SHIFTIT_GITHUB_MILESTONE or proj().version))
 
     return milestone
 
-def _gen_release_notes(template):
-    def _convert(i):
-        return {
-            'number': i.number,
-            'html_url': i.html_url,
-            'title': i.title,
-        }
+def _convert(i):
+    return {
+        'number': i.number,
+        'html_url': i.html_url,
+        'title': i.title,
+        'closed_at': i.closed_at,
+    }
+
+# issues already fetched in this run, keyed by (milestone number, state)
+_issues_cache = {}
+
+def _get_issues(milestone, state):
+    key = (milestone.number, state)
+    if key not in _issues_cache:
+        _issues_cache[key] = [_convert(i) for i in _shiftit().issues(milestone=milestone.number, state=state, number=-1)]
+
+    return _issues_cache[key]
+
+def _prefetch_release_data():
+    '''
+    Fetches the release milestone and then its open and closed issues concurrently
+    '''
 
     milestone = _get_milestone()
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        futures = [pool.submit(_get_issues, milestone, state) for state in ('open', 'closed')]
+        for future in futures:
+            future.result()
+
+    return milestone
+
+def _get_release_notes(milestone):
+    '''
+    Builds the context shared by the HTML and Markdown release notes templates
+    '''
 
-    closed_issues = list(shiftit.iter_issues(milestone=milestone.number, state='closed'))
-    closed_issues.sort(key=lambda i: i.closed_at)
+    closed_issues = sorted(_get_issues(milestone, 'closed'), key=itemgetter('closed_at'))
 
-    release_notes = dict(
+    return dict(
         has_issues = len(closed_issues) > 0,
         issues = closed_issues,
-        proj_name=proj_name,
-        proj_version=proj_version,
+        proj_name=proj().name,
+        proj_version=proj().version,
         milestone_url='https://github.com/citadelgrad/ShiftIt/issues?milestone=%d' % milestone.number,
         )
 
-    return pystache.render(template, release_notes)
+def _sign_archive_with_key(path, key_file):
+    '''
+    Signs the archive with the given EdDSA private key and returns its signature and size
+    '''
+
+    with open(DecryptedFiles.get_decrypted_key_path(key_file),'rt') as f:
+        seed = base64.b64decode(f.read().strip())
+
+    # older Sparkle keys store the expanded private key, which libsodium cannot sign with
+    if len(seed) != 32:
+        raise Exception('Unsupported EdDSA private key in %s, use sign_update instead' % key_file)
+
+    # a single read of the archive gives both the signed bytes and the size
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    signature = nacl.signing.SigningKey(seed).sign(data).signature
+    return base64.b64encode(signature).decode('ascii'), len(data)
+
+def _sign_archive(path):
+    '''
+    Signs the archive and returns its EdDSA signature and size, using Sparkle's sign_update tool unless a private key file is set
+    '''
+
+    if proj().ed_private_key_file:
+        return _sign_archive_with_key(path, proj().ed_private_key_file)
+
+    # The private key is automatically read from macOS Keychain (service: https://sparkle-project.org, account: ed25519)
+    # Output format: sparkle:edSignature="..." length="..."
+    output = local([proj().sign_update_tool, path], capture=True)
+
+    signature = re.search(r'sparkle:edSignature="([^"]+)"', output)
+    if not signature:
+        raise Exception('Unable to sign %s: %s' % (path, output.strip()))
+
+    # sign_update already read the whole archive, reuse its length instead of another stat
+    length = re.search(r'length="(\d+)"', output)
+    size = int(length.group(1)) if length else os.stat(path).st_size
+
+    return signature.group(1), size
+
+def _write_release_notes(release_notes):
+    with open(proj().release_notes_html_file,"w") as f:
+        f.write(chevron.render(_parsed_release_notes_html, release_notes))
+        puts('Written '+proj().release_notes_html_file)
+
+def _write_appcast(release_notes):
+    # verify that appcast URL matches
+    appcast_url = _read_plist(proj().info_plist)['SUFeedURL'].strip()
+
+    # dependencies
+    execute(archive)
+    _write_release_notes(release_notes)
+
+    # Sign with EdDSA using Sparkle's sign_update tool
+    signature, size = _sign_archive(proj().archive_path)
+
+    # appcast properties
+    appcast = dict(
+        proj_name=proj().name,
+        proj_appcast_url=appcast_url,
+        proj_version=proj().version,
+        proj_release_notes_url=proj().release_notes_url,
+        date=datetime.datetime.now().strftime('%a, %d %b %G %T %z'),
+        download_url=proj().download_url,
+        download_size=size,
+        download_signature=signature,
+    )
+
+    with open(proj().appcast_file,"w") as f:
+        f.write(chevron.render(_parsed_appcast, appcast))
 
 def _load_github_token():
-    with open(proj_github_token_file,'rt') as f:
-        return f.read().strip()
+    encrypted = proj().github_token_file.endswith('.gpg')
+    keychain_item = ['-s', GITHUB_TOKEN_KEYCHAIN_SERVICE, '-a', GITHUB_TOKEN_KEYCHAIN_ACCOUNT]
+
+    if encrypted:
+        token = local(['security', 'find-generic-password'] + keychain_item + ['-w'], capture=True).strip()
+        if token:
+            return token
+
+    with open(DecryptedFiles.get_decrypted_key_path(proj().github_token_file),'rt') as f:
+        token = f.read().strip()
+
+    if encrypted:
+        local(['security', 'add-generic-password', '-U'] + keychain_item + ['-w', token], capture=True)
+
+    return token
 
 ################################################################################
 ## Project settings
 ################################################################################
 
-proj_src_dir = os.path.join(os.getcwd(), proj_src_dir)
-proj_build_dir = os.path.join(os.getcwd(), 'build')
-proj_app_dir = os.path.join(proj_src_dir,'build','Release',proj_name+'.app')
-proj_public_key = os.path.join(proj_src_dir,'dsa_pub.pem')
-proj_info_plist = os.path.join(proj_src_dir, proj_info_plist)
+@functools.lru_cache(maxsize=1)
+def proj():
+    '''
+    Returns the project settings, computed on first use so that loading the fabfile stays cheap
+    '''
+
+    p = SimpleNamespace()
+
+    p.name = 'ShiftIt'
+    p.src_dir = os.path.join(os.getcwd(), 'ShiftIt')
+    p.build_dir = os.path.join(os.getcwd(), 'build')
+    p.app_dir = os.path.join(p.src_dir,'build','Release',p.name+'.app')
+    p.public_key = os.path.join(p.src_dir,'dsa_pub.pem')
+    p.info_plist = os.path.join(p.src_dir, 'ShiftIt-Info.plist')
+
+    # GitHub token for release automation
+    p.github_token_file = os.environ.get('SHIFTIT_GITHUB_TOKEN', os.path.expanduser('~/Keys/ShiftIt/github.token'))
+
+    # Sparkle sign_update tool path - reads EdDSA key from macOS Keychain by default
+    # The private key is stored in Keychain under service "https://sparkle-project.org" with account "ed25519"
+    p.sign_update_tool = os.environ.get('SHIFTIT_SIGN_UPDATE', os.path.join(os.path.dirname(__file__), 'ShiftIt', 'bin', 'sign_update'))
+
+    # Optional EdDSA private key file as exported by `generate_keys -x` (may be gpg-encrypted)
+    # When set the archive is signed in-process with PyNaCl instead of running sign_update
+    p.ed_private_key_file = os.environ.get('SHIFTIT_ED_PRIVATE_KEY')
+
+    # zlib compression level (0-9) used by ditto when archiving the app; lower is faster but makes a bigger download
+    p.archive_compression_level = os.environ.get('SHIFTIT_ARCHIVE_COMPRESSION_LEVEL')
 
-proj_version = _get_bundle_version(proj_info_plist)
-proj_archive_name = proj_name + '-' + proj_version + '.zip'
-proj_archive_path = os.path.join(proj_build_dir, proj_archive_name)
+    p.version = _get_bundle_version(p.info_plist)
+    p.archive_name = p.name + '-' + p.version + '.zip'
+    p.archive_path = os.path.join(p.build_dir, p.archive_name)
 
-proj_download_url = 'https://github.com/citadelgrad/ShiftIt/releases/download/version-%s/%s' % (proj_version, proj_archive_name)
-proj_release_notes_url = 'http://htmlpreview.github.com/?https://raw.github.com/citadelgrad/ShiftIt/master/release/release-notes-'+proj_version+'.html'
-proj_release_notes_html_file = os.path.join(os.getcwd(),'release','release-notes-'+proj_version+'.html')
-proj_appcast_file = os.path.join(os.getcwd(),'release','appcast.xml')
-proj_github_token = _load_github_token()
+    p.download_url = 'https://github.com/citadelgrad/ShiftIt/releases/download/version-%s/%s' % (p.version, p.archive_name)
+    p.release_notes_url = 'http://htmlpreview.github.com/?https://raw.github.com/citadelgrad/ShiftIt/master/release/release-notes-'+p.version+'.html'
+    p.release_notes_html_file = os.path.join(os.getcwd(),'release','release-notes-'+p.version+'.html')
+    p.appcast_file = os.path.join(os.getcwd(),'release','appcast.xml')
+
+    return p
 
 ################################################################################
 ## Globals
 ################################################################################
 
-github = github3.login(token=proj_github_token)
-shiftit = github.repository(SHIFTIT_GITHUB_USER, SHIFTIT_GITHUB_REPO)
+# logged in on first use so that tasks not talking to GitHub skip the token and the network
+@functools.lru_cache(maxsize=1)
+def _shiftit():
+    github = github3.login(token=_load_github_token())
+    return github.repository(SHIFTIT_GITHUB_USER, SHIFTIT_GITHUB_REPO)
 
 ################################################################################
 ## Tasks
@@ -252,8 +406,8 @@ def info(ctx):
     '''
 
     print('Build info:')
-    for (k,v) in [(k,v) for (k,v) in globals().items() if k.startswith('proj_')]:
-        print("\t%s: %s" % (k[len('proj_'):],v))
+    for (k,v) in vars(proj()).items():
+        print("\t%s: %s" % (k,v))
 
 @task
 def build(ctx):
@@ -261,8 +415,9 @@ def build(ctx):
     Makes a build by executing xcodebuild
     '''
 
-    with lcd(proj_src_dir):
-        local('xcodebuild -target %s -configuration Release' % proj_name)
+    # build independent targets in parallel on every core and skip the index store, which only the IDE uses
+    local(['xcodebuild', '-target', proj().name, '-configuration', 'Release',
+           '-parallelizeTargets', '-jobs', str(os.cpu_count() or 1), 'COMPILER_INDEX_STORE_ENABLE=NO'], cwd=proj().src_dir)
 
 @task
 def archive(ctx):
@@ -271,13 +426,16 @@ def archive(ctx):
     '''
 
     execute(build)
-    local('ditto -ck --keepParent %s %s' % (proj_app_dir, proj_archive_path))
+
+    # ditto keeps the symlinks and extended attributes the code signature relies on
+    options = ['-ck', '--keepParent']
+    if proj().archive_compression_level:
+        options += ['--zlibCompressionLevel', proj().archive_compression_level]
+    local(['ditto'] + options + [proj().app_dir, proj().archive_path])
 
 @task
 def release_notes(ctx):
-    with open(proj_release_notes_html_file,"w") as f:
-        f.write(_gen_release_notes(release_notes_template_html))
-        puts('Written '+proj_release_notes_html_file)
+    _write_release_notes(_get_release_notes(_get_milestone()))
 
 @task
 def appcast(ctx):
@@ -285,37 +443,7 @@ def appcast(ctx):
     Prepare the release: sign the build, generate appcast, generate release notes, commit and push.
     '''
 
-    milestone = _get_milestone()
-
-    # verify that appcast URL matches
-    tree = ElementTree.parse(proj_info_plist)
-    root = tree.getroot().find('dict')
-    elem = list(root.findall('*'))
-    appcast_url = _find(lambda kv: kv[0].text == 'SUFeedURL', zip(*[iter(elem)]*2))[1].text.strip()
-
-    # dependencies
-    execute(archive)
-    execute(release_notes)
-
-    # Sign with EdDSA using Sparkle's sign_update tool
-    # The private key is automatically read from macOS Keychain (service: https://sparkle-project.org, account: ed25519)
-    sign_result = local('%s %s' % (proj_sign_update_tool, proj_archive_path), capture=True)
-    signature = sign_result.strip()
-
-    # appcast properties
-    appcast = dict(
-        proj_name=proj_name,
-        proj_appcast_url=appcast_url,
-        proj_version=proj_version,
-        proj_release_notes_url=proj_release_notes_url,
-        date=datetime.datetime.now().strftime('%a, %d %b %G %T %z'),
-        download_url=proj_download_url,
-        download_size=os.path.getsize(proj_archive_path),
-        download_signature=signature,
-    )
-
-    with open(proj_appcast_file,"w") as f:
-        f.write(pystache.render(appcast_template, appcast))
+    _write_appcast(_get_release_notes(_get_milestone()))
 
 @task
 def release(ctx):
@@ -324,29 +452,29 @@ def release(ctx):
     '''
 
     with settings(warn_only=True):
-        if not local('git diff-index --quiet HEAD --').return_code:
+        if local(['git', 'diff-index', '--quiet', 'HEAD', '--']).returncode:
             puts('Warning: there are pending changes in the repository. Run git status')
 
-    milestone = _get_milestone()
-    open_issues = list(shiftit.iter_issues(milestone=milestone.number, state='open'))
+    milestone = _prefetch_release_data()
+    open_issues = _get_issues(milestone, 'open')
     if len(open_issues) > 0:
         puts('Warning: there are still open issues')
         for i in open_issues:
-            print('\t * #%s: %s' % (i.number, i.title))
-
+            print('\t * #%s: %s' % (i['number'], i['title']))
 
-    execute(appcast)
+    release_notes = _get_release_notes(milestone)
+    _write_appcast(release_notes)
 
     puts('\n')
     puts('='*100)
     puts(green('1. Commit appcast and release notes'))
-    puts('message: "Added appcast and release notes for the ShiftIt %s release"' % proj_version)
+    puts('message: "Added appcast and release notes for the ShiftIt %s release"' % proj().version)
     puts(green('2. Finnish the git flow'))
     puts(green('3. Close milestone at: https://github.com/citadelgrad/ShiftIt/milestones'))
     puts(green('4. Release at: https://github.com/citadelgrad/ShiftIt/releases and drafts a new release with:'))
     puts('-'*100)
-    puts('tag: version-'+proj_version)
-    puts('title: '+proj_version)
+    puts('tag: version-'+proj().version)
+    puts('title: '+proj().version)
     puts('description:')
-    puts(_gen_release_notes(release_notes_template_md))
+    puts(chevron.render(_parsed_release_notes_md, release_notes))
     puts('-'*100)